@@ -32,12 +32,13 @@ J. Chem. Phys. 147, 164119 (2017)
 import os
 
 import copy
-import ctypes
 import warnings
 import tempfile
 import numpy
 import h5py
 import scipy.linalg
+import scipy.sparse
+from concurrent.futures import ThreadPoolExecutor
 from pyscf import lib
 from pyscf import gto
 from pyscf.lib import logger
@@ -51,7 +52,6 @@ from pyscf.pbc.df import aft
 from pyscf.pbc.df import df_jk
 from pyscf.pbc.df import df_ao2mo
 from pyscf.pbc.df.aft import estimate_eta, get_nuc
-from pyscf.pbc.df.df_jk import zdotCN
 from pyscf.pbc.lib.kpts_helper import (is_zero, gamma_point, member, unique,
                                        KPT_DIFF_TOL)
 from pyscf.pbc.df.aft import _sub_df_jk_
@@ -59,6 +59,9 @@ from pyscf import __config__
 
 LINEAR_DEP_THR = getattr(__config__, 'pbc_df_df_DF_lindep', 1e-9)
 LONGRANGE_AFT_TURNOVER_THRESHOLD = 2.5
+# Max number of elements in the temporary array of fuse
+FUSE_BLKSIZE = 4194304
+K_THREADS_NAUX_THRESHOLD = getattr(__config__, 'pbc_df_df_k_threads_naux_threshold', 500)
 
 
 def make_modrho_basis(cell, auxbasis=None, drop_eta=None):
@@ -118,23 +121,26 @@ def make_modchg_basis(auxcell, smooth_eta):
     #   auxcell. The smooth functions may be used to carry the charge
     chgcell = copy.copy(auxcell)  # smooth model density for coulomb integral to carry charge
     half_sph_norm = .5/numpy.sqrt(numpy.pi)
-    chg_bas = []
-    chg_env = [smooth_eta]
     ptr_eta = auxcell._env.size
-    ptr = ptr_eta + 1
     l_max = auxcell._bas[:,gto.ANG_OF].max()
 # gaussian_int(l*2+2) for multipole integral:
 # \int (r^l e^{-ar^2} * Y_{lm}) (r^l Y_{lm}) r^2 dr d\Omega
-    norms = [half_sph_norm/gto.gaussian_int(l*2+2, smooth_eta)
-             for l in range(l_max+1)]
-    for ia in range(auxcell.natm):
-        for l in set(auxcell._bas[auxcell._bas[:,gto.ATOM_OF]==ia, gto.ANG_OF]):
-            chg_bas.append([ia, l, 1, 1, 0, ptr_eta, ptr, 0])
-            chg_env.append(norms[l])
-            ptr += 1
+    norms = half_sph_norm/gto.gaussian_int(numpy.arange(l_max+1)*2+2, smooth_eta)
+    # One compensating shell for each angular momentum of each atom, sorted
+    # by atom then angular momentum
+    atm_l = numpy.unique(auxcell._bas[:,[gto.ATOM_OF,gto.ANG_OF]], axis=0)
+    nbas_chg = len(atm_l)
+    chg_bas = numpy.zeros((nbas_chg,gto.BAS_SLOTS), dtype=numpy.int32)
+    chg_bas[:,gto.ATOM_OF ] = atm_l[:,0]
+    chg_bas[:,gto.ANG_OF  ] = atm_l[:,1]
+    chg_bas[:,gto.NPRIM_OF] = 1
+    chg_bas[:,gto.NCTR_OF ] = 1
+    chg_bas[:,gto.PTR_EXP ] = ptr_eta
+    chg_bas[:,gto.PTR_COEFF] = ptr_eta + 1 + numpy.arange(nbas_chg)
+    chg_env = numpy.append(smooth_eta, norms[atm_l[:,1]])
 
     chgcell._atm = auxcell._atm
-    chgcell._bas = numpy.asarray(chg_bas, dtype=numpy.int32).reshape(-1,gto.BAS_SLOTS)
+    chgcell._bas = chg_bas
     chgcell._env = numpy.hstack((auxcell._env, chg_env))
     # _estimate_rcut is based on the integral overlap. It's likely too tight for
     # rcut of the model charge. Using the value of functions at rcut seems enough
@@ -147,6 +153,171 @@ def make_modchg_basis(auxcell, smooth_eta):
     logger.debug1(auxcell, 'chgcell.rcut %s', chgcell.rcut)
     return chgcell
 
+def _get_2c2e(mydf, fused_cell, naux, uniq_kpts,
+              k_threads_naux_threshold=K_THREADS_NAUX_THRESHOLD):
+    '''The 2-center Coulomb integrals of the fused auxiliary basis for each
+    k-point in uniq_kpts. The compensating functions (the last
+    fused_cell.nao_nr()-naux functions) are not fused with the auxiliary
+    functions in the output.
+
+    This function can be overwritten by the GDF class to provide
+    alternative implementations (e.g. with GPU).
+
+    If there are several k-points and naux is smaller than
+    k_threads_naux_threshold, the k-points are processed by concurrent
+    threads.
+    '''
+    log = logger.Logger(mydf.stdout, mydf.verbose)
+    cell = mydf.cell
+    mesh = mydf.mesh
+    Gv, Gvbase, kws = cell.get_Gv_weights(mesh)
+    b = cell.reciprocal_vectors()
+    gxyz = lib.cartesian_prod([numpy.arange(len(x)) for x in Gvbase])
+    ngrids = gxyz.shape[0]
+
+    # j2c ~ (-kpt_ji | kpt_ji)
+    # Generally speaking, the int2c2e integrals with lattice sum applied on
+    # |j> are not necessary hermitian because int2c2e cannot be made converged
+    # with regular lattice sum unless the lattice sum vectors (from
+    # cell.get_lattice_Ls) are symmetric. After adding the planewaves
+    # contributions and fuse(fuse(j2c)), the output matrix is hermitian.
+    j2c = fused_cell.pbc_intor('int2c2e', hermi=0, kpts=uniq_kpts)
+
+    nfused = fused_cell.nao_nr()
+    nchg = nfused - naux
+    # The plane-wave contributions to the (compensating, auxiliary) block
+    # (j2c_ca) and the (compensating, compensating) block (j2c_cc). j2c_cc
+    # is hermitian. Only its lower triangular part is computed with ?syrk or
+    # ?herk as sum_G B(G) B(G).T, B = Lk*sqrt(|coulG|). For the negative
+    # coulG (e.g. G=0 for 2D systems), their contributions are subtracted
+    # twice.
+    j2c_ca = []
+    j2c_cc = []
+    for k, kpt in enumerate(uniq_kpts):
+        if is_zero(kpt):
+            j2c_ca.append(numpy.zeros((nchg,naux)))
+            j2c_cc.append(numpy.zeros((nchg,nchg), order='F'))
+        else:
+            j2c_ca.append(numpy.zeros((2,nchg,naux)))
+            j2c_cc.append(numpy.zeros((nchg,nchg), order='F', dtype=numpy.complex128))
+    syrk = scipy.linalg.get_blas_funcs('syrk', dtype=numpy.double)
+    herk = scipy.linalg.get_blas_funcs('herk', dtype=numpy.complex128)
+
+    # BLAS and ft_ao cannot saturate the cores with a small auxiliary basis.
+    # The k-points are then distributed over a few threads, each running with
+    # a part of the OpenMP threads. Note lib.with_omp_threads only limits
+    # OpenMP. If the BLAS library is threaded with pthreads rather than OpenMP,
+    # its thread pool is not split among the workers and the cores may be
+    # oversubscribed. Set k_threads_naux_threshold=0 to disable the threads
+    # in that case.
+    nthreads = lib.num_threads()
+    if len(uniq_kpts) > 1 and naux < k_threads_naux_threshold:
+        nworkers = min(len(uniq_kpts), nthreads // 2)
+    else:
+        nworkers = 1
+    nworkers = max(nworkers, 1)
+
+    max_memory = max(2000, mydf.max_memory - lib.current_memory()[0])
+    blksize = max(2048, int(max_memory*.4e6/16/nfused/nworkers))
+    log.debug2('max_memory %s (MB)  blocksize %s  nworkers %d',
+               max_memory, blksize, nworkers)
+
+    def contract_kpts(kpt_ids, Lkbuf, wbuf, Bbuf):
+        for k in kpt_ids:
+            kpt = uniq_kpts[k]
+            coulG = mydf.weighted_coulG(kpt, False, mesh)
+            for p0, p1 in lib.prange(0, ngrids, blksize):
+                nG = p1 - p0
+                Lk = numpy.ndarray((nfused,nG*2), buffer=Lkbuf)
+                w = numpy.ndarray((nchg,nG*2), buffer=wbuf[0])
+                aoaux = ft_ao.ft_ao(fused_cell, Gv[p0:p1], None, b, gxyz[p0:p1], Gvbase, kpt)
+                Lk[:,:nG] = aoaux.real.T
+                Lk[:,nG:] = aoaux.imag.T
+                aoaux = None
+                coulG_blk = coulG[p0:p1]
+                # w = [LkR*coulG, LkI*coulG]
+                numpy.multiply(Lk[naux:], numpy.tile(coulG_blk, 2), out=w)
+                sqrt_coulG = numpy.tile(numpy.sqrt(abs(coulG_blk)), 2)
+                neg = numpy.where(coulG_blk < 0)[0]
+
+                if is_zero(kpt):  # kpti == kptj
+                    # wR * LkR.T + wI * LkI.T
+                    lib.ddot(w, Lk[:naux].T, 1, j2c_ca[k], 1)
+                    # B = [LkR*sqrt(coulG), LkI*sqrt(coulG)]
+                    B = numpy.ndarray((nchg,nG*2), buffer=Bbuf)
+                    numpy.multiply(Lk[naux:], sqrt_coulG, out=B)
+                    j2c_cc[k] = syrk(1., B.T, beta=1., c=j2c_cc[k], trans=1,
+                                     lower=1, overwrite_c=1)
+                    if neg.size > 0:
+                        B = B[:,numpy.append(neg, neg+nG)]
+                        j2c_cc[k] = syrk(-2., B, beta=1., c=j2c_cc[k], trans=0,
+                                         lower=1, overwrite_c=1)
+                else:
+                    # conj(w) * Lk.T
+                    #   real part: [ wR, wI] * [LkR, LkI].T
+                    #   imag part: [-wI, wR] * [LkR, LkI].T
+                    lib.ddot(w, Lk[:naux].T, 1, j2c_ca[k][0], 1)
+                    w1 = numpy.ndarray((nchg,nG*2), buffer=wbuf[1])
+                    numpy.negative(w[:,nG:], out=w1[:,:nG])
+                    w1[:,nG:] = w[:,:nG]
+                    lib.ddot(w1, Lk[:naux].T, 1, j2c_ca[k][1], 1)
+                    # j2c_cc = conj(B) * B.T
+                    B = numpy.ndarray((nchg,nG), dtype=numpy.complex128, buffer=Bbuf)
+                    numpy.multiply(Lk[naux:,:nG], sqrt_coulG[:nG], out=B.real)
+                    numpy.multiply(Lk[naux:,nG:], sqrt_coulG[:nG], out=B.imag)
+                    j2c_cc[k] = herk(1., B.T, beta=1., c=j2c_cc[k], trans=2,
+                                     lower=1, overwrite_c=1)
+                    if neg.size > 0:
+                        j2c_cc[k] = herk(-2., B[:,neg].T, beta=1., c=j2c_cc[k],
+                                         trans=2, lower=1, overwrite_c=1)
+                B = None
+
+    # buffers (one set for each worker) for the Fourier transformed fused
+    # basis, the coulG-weighted compensating functions, and B. The real and
+    # imaginary parts are stored side by side in each row, [Re | Im], so that
+    # the sum over the real and imaginary parts is carried out in one GEMM.
+    bufs = [(numpy.empty(nfused*blksize*2),
+             numpy.empty((2,nchg*blksize*2)),
+             numpy.empty(nchg*blksize, dtype=numpy.complex128))
+            for i in range(nworkers)]
+    # The plane-wave contributions of each k-point are computed independently.
+    kpt_ids = [range(i, len(uniq_kpts), nworkers) for i in range(nworkers)]
+    if nworkers == 1:
+        contract_kpts(kpt_ids[0], *bufs[0])
+    else:
+        # The number of OpenMP threads is a per-thread setting. It needs to
+        # be set in each worker thread.
+        omp_threads = max(1, nthreads // nworkers)
+        def contract_kpts_in_thread(*args):
+            with lib.with_omp_threads(omp_threads):
+                contract_kpts(*args)
+
+        with ThreadPoolExecutor(max_workers=nworkers) as executor:
+            futures = [executor.submit(contract_kpts_in_thread, kpt_ids[i], *bufs[i])
+                       for i in range(nworkers)]
+            for f in futures:
+                f.result()
+    bufs = None
+
+    for k, kpt in enumerate(uniq_kpts):
+        if is_zero(kpt):
+            j2c_p = j2c_ca[k]
+        else:
+            j2c_p = j2c_ca[k][0] + j2c_ca[k][1] * 1j
+        j2c[k][naux:,:naux] -= j2c_p
+        j2c[k][:naux,naux:] -= j2c_p.conj().T
+        j2c_p = numpy.tril(j2c_cc[k])
+        j2c[k][naux:,naux:] -= j2c_p + numpy.tril(j2c_p, -1).conj().T
+        j2c_p = j2c_ca[k] = j2c_cc[k] = None
+
+        # Symmetrizing the matrix is not must if the integrals converged.
+        # Since symmetry cannot be enforced in the pbc_intor('int2c2e'),
+        # the aggregated j2c here may have error in hermitian if the range of
+        # lattice sum is not big enough.
+        j2c[k] = lib.hermi_sum(j2c[k], inplace=True)
+        j2c[k] *= .5
+    return j2c
+
 # kpti == kptj: s2 symmetry
 # kpti == kptj == 0 (gamma point): real
 def _make_j3c(mydf, cell, auxcell, kptij_lst, cderi_file):
@@ -187,42 +358,10 @@ def _make_j3c(mydf, cell, auxcell, kptij_lst, cderi_file):
 
     log.debug('Num uniq kpts %d', len(uniq_kpts))
     log.debug2('uniq_kpts %s', uniq_kpts)
-    # j2c ~ (-kpt_ji | kpt_ji)
-    # Generally speaking, the int2c2e integrals with lattice sum applied on
-    # |j> are not necessary hermitian because int2c2e cannot be made converged
-    # with regular lattice sum unless the lattice sum vectors (from
-    # cell.get_lattice_Ls) are symmetric. After adding the planewaves
-    # contributions and fuse(fuse(j2c)), the output matrix is hermitian.
-    j2c = fused_cell.pbc_intor('int2c2e', hermi=0, kpts=uniq_kpts)
-
-    max_memory = max(2000, mydf.max_memory - lib.current_memory()[0])
-    blksize = max(2048, int(max_memory*.4e6/16/fused_cell.nao_nr()))
-    log.debug2('max_memory %s (MB)  blocksize %s', max_memory, blksize)
-    for k, kpt in enumerate(uniq_kpts):
-        coulG = mydf.weighted_coulG(kpt, False, mesh)
-        for p0, p1 in lib.prange(0, ngrids, blksize):
-            aoaux = ft_ao.ft_ao(fused_cell, Gv[p0:p1], None, b, gxyz[p0:p1], Gvbase, kpt).T
-            LkR = numpy.asarray(aoaux.real, order='C')
-            LkI = numpy.asarray(aoaux.imag, order='C')
-            aoaux = None
-
-            if is_zero(kpt):  # kpti == kptj
-                j2c_p  = lib.ddot(LkR[naux:]*coulG[p0:p1], LkR.T)
-                j2c_p += lib.ddot(LkI[naux:]*coulG[p0:p1], LkI.T)
-            else:
-                j2cR, j2cI = zdotCN(LkR[naux:]*coulG[p0:p1],
-                                    LkI[naux:]*coulG[p0:p1], LkR.T, LkI.T)
-                j2c_p = j2cR + j2cI * 1j
-            j2c[k][naux:] -= j2c_p
-            j2c[k][:naux,naux:] -= j2c_p[:,:naux].conj().T
-            j2c_p = LkR = LkI = None
-        # Symmetrizing the matrix is not must if the integrals converged.
-        # Since symmetry cannot be enforced in the pbc_intor('int2c2e'),
-        # the aggregated j2c here may have error in hermitian if the range of
-        # lattice sum is not big enough.
-        j2c[k] = (j2c[k] + j2c[k].conj().T) * .5
-        fswap['j2c/%d'%k] = fuse(fuse(j2c[k]).T).T
-    j2c = coulG = None
+    j2c = mydf._get_2c2e(fused_cell, naux, uniq_kpts)
+    for k in range(len(uniq_kpts)):
+        fswap['j2c/%d'%k] = fuse(fuse(j2c[k]), axis=1)
+    j2c = None
 
     def cholesky_decomposed_metric(uniq_kptji_id):
         j2c = numpy.asarray(fswap['j2c/%d'%uniq_kptji_id])
@@ -264,23 +403,41 @@ def _make_j3c(mydf, cell, auxcell, kptij_lst, cderi_file):
         log.debug1('adapted_ji_idx = %s', adapted_ji_idx)
 
         j2c, j2c_negative, j2ctag = cholesky_j2c
+        if j2c_negative is not None:
+            # Transform the positive and negative parts of the metric with
+            # one GEMM
+            naux_positive = j2c.shape[0]
+            j2c = numpy.vstack((j2c, j2c_negative))
+        # j3c is real if kpti == kptj == 0
+        j3c_real = [is_zero(kpt) and gamma_point(kptj) for kptj in adapted_kptjs]
 
         shls_slice = (auxcell.nbas, fused_cell.nbas)
         Gaux = ft_ao.ft_ao(fused_cell, Gv, shls_slice, b, gxyz, Gvbase, kpt)
         wcoulG = mydf.weighted_coulG(kpt, False, mesh)
         Gaux *= wcoulG.reshape(-1,1)
-        kLR = Gaux.real.copy('C')
-        kLI = Gaux.imag.copy('C')
-        Gaux = None
+        if any(j3c_real):
+            kLR = Gaux.real.copy('C')
+            kLI = Gaux.imag.copy('C')
+        if all(j3c_real):
+            Gaux = None
+        else:
+            # Gaux.conj().T is passed to zgemm for complex j3c
+            Gaux = numpy.conj(Gaux, out=Gaux)
 
+        # vbar is the interaction between the background charge
+        # and the auxiliary basis.  0D, 1D, 2D do not have vbar.
+        vbar_idx = []
         if is_zero(kpt):  # kpti == kptj
             aosym = 's2'
             nao_pair = nao*(nao+1)//2
 
             if cell.dimension == 3:
                 vbar = mydf.auxbar(fused_cell)
-                ovlp = cell.pbc_intor('int1e_ovlp', hermi=1, kpts=adapted_kptjs)
-                ovlp = [lib.pack_tril(s) for s in ovlp]
+                vbar_idx = numpy.nonzero(vbar)[0]
+                # The overlap is not needed if all elements of vbar are zero
+                if len(vbar_idx) > 0:
+                    ovlp = cell.pbc_intor('int1e_ovlp', hermi=1, kpts=adapted_kptjs)
+                    ovlp = [lib.pack_tril(s) for s in ovlp]
         else:
             aosym = 's1'
             nao_pair = nao**2
@@ -288,6 +445,10 @@ def _make_j3c(mydf, cell, auxcell, kptij_lst, cderi_file):
         mem_now = lib.current_memory()[0]
         log.debug2('memory = %s', mem_now)
         max_memory = max(2000, mydf.max_memory-mem_now)
+        if Gaux is not None and any(j3c_real):
+            # kLR and kLI are held along with Gaux when real and complex j3c
+            # are computed for the same kpt
+            max_memory = max(2000, max_memory - (kLR.nbytes+kLI.nbytes)/1e6)
         # nkptj for 3c-coulomb arrays plus 1 Lpq array
         buflen = min(max(int(max_memory*.38e6/16/naux/(nkptj+1)), 1), nao_pair)
         shranges = _guess_shell_ranges(cell, buflen, aosym)
@@ -299,34 +460,33 @@ def _make_j3c(mydf, cell, auxcell, kptij_lst, cderi_file):
             Gblksize = max(16, int(max_memory*.2e6/16/buflen/(nkptj+1)))
         Gblksize = min(Gblksize, ngrids, 16384)
 
+        # Dataset handles of the intermediates, looked up once for all
+        # column slices
+        j3c_dsets = [[fswap['j3c-junk/%d/%d'%(idx,i)] for i in range(nsegs)]
+                     for idx in adapted_ji_idx]
         def load(aux_slice):
             col0, col1 = aux_slice
-            j3cR = []
-            j3cI = []
-            for k, idx in enumerate(adapted_ji_idx):
-                v = numpy.vstack([fswap['j3c-junk/%d/%d'%(idx,i)][0,col0:col1].T
-                                  for i in range(nsegs)])
-                # vbar is the interaction between the background charge
-                # and the auxiliary basis.  0D, 1D, 2D do not have vbar.
-                if is_zero(kpt) and cell.dimension == 3:
-                    for i in numpy.where(vbar != 0)[0]:
-                        v[i] -= vbar[i] * ovlp[k][col0:col1]
-                j3cR.append(numpy.asarray(v.real, order='C'))
-                if is_zero(kpt) and gamma_point(adapted_kptjs[k]):
-                    j3cI.append(None)
+            j3c = []
+            for k, dsets in enumerate(j3c_dsets):
+                v = numpy.vstack([dset[0,col0:col1].T for dset in dsets])
+                for i in vbar_idx:
+                    v[i] -= vbar[i] * ovlp[k][col0:col1]
+                if j3c_real[k]:
+                    j3c.append(numpy.asarray(v.real, order='C'))
                 else:
-                    j3cI.append(numpy.asarray(v.imag, order='C'))
+                    j3c.append(numpy.asarray(v, dtype=numpy.complex128, order='C'))
                 v = None
-            return j3cR, j3cI
+            return j3c
 
-        pqkRbuf = numpy.empty(buflen*Gblksize)
-        pqkIbuf = numpy.empty(buflen*Gblksize)
+        if any(j3c_real):
+            pqkRbuf = numpy.empty(buflen*Gblksize)
+            pqkIbuf = numpy.empty(buflen*Gblksize)
         # buf for ft_aopair
         buf = numpy.empty(nkptj*buflen*Gblksize, dtype=numpy.complex128)
         cols = [sh_range[2] for sh_range in shranges]
         locs = numpy.append(0, numpy.cumsum(cols))
         tasks = zip(locs[:-1], locs[1:])
-        for istep, (j3cR, j3cI) in enumerate(lib.map_with_prefetch(load, tasks)):
+        for istep, j3c in enumerate(lib.map_with_prefetch(load, tasks)):
             bstart, bend, ncol = shranges[istep]
             log.debug1('int3c2e [%d/%d], AO [%d:%d], ncol = %d',
                        istep+1, len(shranges), bstart, bend, ncol)
@@ -342,32 +502,33 @@ def _make_j3c(mydf, cell, auxcell, kptij_lst, cderi_file):
                 nG = p1 - p0
                 for k, ji in enumerate(adapted_ji_idx):
                     aoao = dat[k].reshape(nG,ncol)
-                    pqkR = numpy.ndarray((ncol,nG), buffer=pqkRbuf)
-                    pqkI = numpy.ndarray((ncol,nG), buffer=pqkIbuf)
-                    pqkR[:] = aoao.real.T
-                    pqkI[:] = aoao.imag.T
-
-                    lib.dot(kLR[p0:p1].T, pqkR.T, -1, j3cR[k][naux:], 1)
-                    lib.dot(kLI[p0:p1].T, pqkI.T, -1, j3cR[k][naux:], 1)
-                    if not (is_zero(kpt) and gamma_point(adapted_kptjs[k])):
-                        lib.dot(kLR[p0:p1].T, pqkI.T, -1, j3cI[k][naux:], 1)
-                        lib.dot(kLI[p0:p1].T, pqkR.T,  1, j3cI[k][naux:], 1)
+                    if j3c_real[k]:
+                        # Split the real and imaginary parts in the (G,pq)
+                        # order of aoao. BLAS takes kLR.T as a transposed
+                        # view, no transposed copy is needed.
+                        pqkR = numpy.ndarray((nG,ncol), buffer=pqkRbuf)
+                        pqkI = numpy.ndarray((nG,ncol), buffer=pqkIbuf)
+                        pqkR[:] = aoao.real
+                        pqkI[:] = aoao.imag
+                        lib.dot(kLR[p0:p1].T, pqkR, -1, j3c[k][naux:], 1)
+                        lib.dot(kLI[p0:p1].T, pqkI, -1, j3c[k][naux:], 1)
+                    else:
+                        # j3c -= Gaux.conj().T * aoao with a single zgemm
+                        lib.dot(Gaux[p0:p1].T, aoao, -1, j3c[k][naux:], 1)
 
             for k, ji in enumerate(adapted_ji_idx):
-                if is_zero(kpt) and gamma_point(adapted_kptjs[k]):
-                    v = fuse(j3cR[k])
-                else:
-                    v = fuse(j3cR[k] + j3cI[k] * 1j)
+                v = fuse(j3c[k])
                 if j2ctag == 'CD':
-                    v = scipy.linalg.solve_triangular(j2c, v, lower=True, overwrite_b=True)
+                    v = _trsm_lower(j2c, v)
                     feri['j3c/%d/%d'%(ji,istep)] = v
-                else:
+                elif j2c_negative is None:
                     feri['j3c/%d/%d'%(ji,istep)] = lib.dot(j2c, v)
-
-                # low-dimension systems
-                if j2c_negative is not None:
-                    feri['j3c-/%d/%d'%(ji,istep)] = lib.dot(j2c_negative, v)
-            j3cR = j3cI = None
+                else:
+                    # low-dimension systems
+                    v = lib.dot(j2c, v)
+                    feri['j3c/%d/%d'%(ji,istep)] = v[:naux_positive]
+                    feri['j3c-/%d/%d'%(ji,istep)] = v[naux_positive:]
+            j3c = None
 
         for ji in adapted_ji_idx:
             del(fswap['j3c-junk/%d'%ji])
@@ -597,6 +758,7 @@ class GDF(aft.AFTDF):
         return self
 
     _make_j3c = _make_j3c
+    _get_2c2e = _get_2c2e
 
     def has_kpts(self, kpts):
         if kpts is None:
@@ -626,17 +788,18 @@ class GDF(aft.AFTDF):
             return vbar
 
         half_sph_norm = .5/numpy.sqrt(numpy.pi)
-        for i in range(fused_cell.nbas):
-            l = fused_cell.bas_angular(i)
-            if l == 0:
-                es = fused_cell.bas_exp(i)
-                if es.size == 1:
-                    vbar[aux_loc[i]] = -1/es[0]
-                else:
-                    # Remove the normalization to get the primitive contraction coeffcients
-                    norms = half_sph_norm/gto.gaussian_int(2, es)
-                    cs = numpy.einsum('i,ij->ij', 1/norms, fused_cell._libcint_ctr_coeff(i))
-                    vbar[aux_loc[i]:aux_loc[i+1]] = numpy.einsum('in,i->n', cs, -1/es)
+        bas = fused_cell._bas
+        s_shls = numpy.where(bas[:,gto.ANG_OF] == 0)[0]
+        nprim = bas[s_shls,gto.NPRIM_OF]
+        # Uncontracted s shells
+        shls = s_shls[nprim == 1]
+        vbar[aux_loc[shls]] = -1/fused_cell._env[bas[shls,gto.PTR_EXP]]
+        for i in s_shls[nprim > 1]:
+            es = fused_cell.bas_exp(i)
+            # Remove the normalization to get the primitive contraction coeffcients
+            norms = half_sph_norm/gto.gaussian_int(2, es)
+            cs = fused_cell._libcint_ctr_coeff(i) / norms[:,None]
+            vbar[aux_loc[i]:aux_loc[i+1]] = cs.T.dot(-1/es)
         # TODO: fused_cell.cart and l%2 == 0: # 6d 10f ...
         # Normalization coefficients are different in the same shell for cartesian
         # basis. E.g. the d-type functions, the 5 d-type orbitals are normalized wrt
@@ -822,10 +985,26 @@ def fuse_auxcell(mydf, auxcell):
     naux = aux_loc[-1]
     modchg_offset = -numpy.ones((chgcell.natm,8), dtype=int)
     smooth_loc = chgcell.ao_loc_nr()
-    for i in range(chgcell.nbas):
-        ia = chgcell.bas_atom(i)
-        l  = chgcell.bas_angular(i)
-        modchg_offset[ia,l] = smooth_loc[i]
+    modchg_offset[chgcell._bas[:,gto.ATOM_OF],
+                  chgcell._bas[:,gto.ANG_OF]] = smooth_loc[:-1]
+    # The offset of the compensating shell for each shell of auxcell
+    shell_src_offset = modchg_offset[auxcell._bas[:,gto.ATOM_OF],
+                                     auxcell._bas[:,gto.ANG_OF]]
+
+    # src_map[p] is the compensating function (offset in chgcell) which is
+    # fused to the auxiliary function p, -1 if p has no compensating function.
+    ls = auxcell._bas[:,gto.ANG_OF]
+    if auxcell.cart:
+        nd = (ls+1) * (ls+2) // 2
+    else:
+        nd = ls * 2 + 1
+    shl_id = numpy.repeat(numpy.arange(auxcell.nbas), aux_loc[1:] - aux_loc[:-1])
+    src_map = (shell_src_offset[shl_id] +
+               (numpy.arange(naux) - aux_loc[shl_id]) % nd[shl_id])
+    src_map[shell_src_offset[shl_id] < 0] = -1
+    fuse_mask = src_map >= 0
+    fuse_idx = numpy.where(fuse_mask)[0]
+    src_idx = src_map[fuse_mask]
 
     if auxcell.cart:
         # Normalization coefficients are different in the same shell for cartesian
@@ -836,50 +1015,42 @@ def fuse_auxcell(mydf, auxcell):
         # problem.  First is to transform the cartesian basis and scale the 3s (for
         # d functions), 4p (for f functions) ... then transform back. The second is to
         # remove the 3s, 4p functions. The function below is the second solution
-        c2s_fn = gto.moleintor.libcgto.CINTc2s_ket_sph
-        aux_loc_sph = auxcell.ao_loc_nr(cart=False)
-        naux_sph = aux_loc_sph[-1]
-        def fuse(Lpq):
-            Lpq, chgLpq = Lpq[:naux], Lpq[naux:]
-            if Lpq.ndim == 1:
-                npq = 1
-                Lpq_sph = numpy.empty(naux_sph, dtype=Lpq.dtype)
+        nchg = smooth_loc[-1]
+        c2s = []
+        for i in range(auxcell.nbas):
+            l = auxcell.bas_angular(i)
+            c2s.extend([gto.cart2sph(l, normalized='sp').T] * auxcell.bas_nctr(i))
+        c2s = scipy.sparse.block_diag(c2s, format='csr')
+        # Fold the subtraction of the compensating functions into the
+        # transformation:  Lpq_sph = c2s * Lpq - c2s * chg_map * chgLpq
+        chg_map = scipy.sparse.csr_matrix(
+            (numpy.ones(fuse_idx.size), (fuse_idx, src_idx)), shape=(naux,nchg))
+        c2s = scipy.sparse.hstack([c2s, -c2s.dot(chg_map)], format='csr')
+        def fuse(Lpq, axis=0):
+            if axis == 1 and Lpq.ndim == 2:
+                # (c2s * Lpq.T).T, both transposes are views
+                return c2s.dot(Lpq.T).T
             else:
-                npq = Lpq.shape[1]
-                Lpq_sph = numpy.empty((naux_sph,npq), dtype=Lpq.dtype)
-            if Lpq.dtype == numpy.complex128:
-                npq *= 2  # c2s_fn supports double only, *2 to handle complex
-            for i in range(auxcell.nbas):
-                l  = auxcell.bas_angular(i)
-                ia = auxcell.bas_atom(i)
-                p0 = modchg_offset[ia,l]
-                if p0 >= 0:
-                    nd = (l+1) * (l+2) // 2
-                    c0, c1 = aux_loc[i], aux_loc[i+1]
-                    s0, s1 = aux_loc_sph[i], aux_loc_sph[i+1]
-                    for i0, i1 in lib.prange(c0, c1, nd):
-                        Lpq[i0:i1] -= chgLpq[p0:p0+nd]
-
-                    if l < 2:
-                        Lpq_sph[s0:s1] = Lpq[c0:c1]
-                    else:
-                        Lpq_cart = numpy.asarray(Lpq[c0:c1], order='C')
-                        c2s_fn(Lpq_sph[s0:s1].ctypes.data_as(ctypes.c_void_p),
-                               ctypes.c_int(npq * auxcell.bas_nctr(i)),
-                               Lpq_cart.ctypes.data_as(ctypes.c_void_p),
-                               ctypes.c_int(l))
-            return Lpq_sph
+                return c2s.dot(Lpq)
     else:
-        def fuse(Lpq):
+        # make_modchg_basis generates a compensating shell for each angular
+        # momentum of each atom. All auxiliary functions are generally fused.
+        fuse_all = fuse_idx.size == naux
+        def fuse(Lpq, axis=0):
+            if axis == 1 and Lpq.ndim == 2:
+                # Fuse the rows of the transposed view in place
+                return fuse(Lpq.T).T
+
             Lpq, chgLpq = Lpq[:naux], Lpq[naux:]
-            for i in range(auxcell.nbas):
-                l  = auxcell.bas_angular(i)
-                ia = auxcell.bas_atom(i)
-                p0 = modchg_offset[ia,l]
-                if p0 >= 0:
-                    nd = l * 2 + 1
-                    for i0, i1 in lib.prange(aux_loc[i], aux_loc[i+1], nd):
-                        Lpq[i0:i1] -= chgLpq[p0:p0+nd]
+            # Subtract the compensating functions in row blocks to bound
+            # the temporary array of the gathered rows
+            blksize = max(1, FUSE_BLKSIZE // max(1, chgLpq[:1].size))
+            for p0, p1 in lib.prange(0, fuse_idx.size, blksize):
+                if fuse_all:
+                    Lpq[p0:p1] -= chgLpq[src_idx[p0:p1]]
+                else:
+                    idx = fuse_idx[p0:p1]
+                    Lpq[idx] -= chgLpq[src_idx[p0:p1]]
             return Lpq
     return fused_cell, fuse
 
@@ -990,6 +1161,19 @@ def _gaussian_int(cell):
     r'''Regular gaussian integral \int g(r) dr^3'''
     return ft_ao.ft_ao(cell, numpy.zeros((1,3)))[0].real
 
+def _trsm_lower(low, b):
+    '''Solve low * x = b for a lower triangular matrix low. b is overwritten
+    if its dtype matches the BLAS function.'''
+    trsm = scipy.linalg.get_blas_funcs('trsm', (low, b))
+    low = numpy.asarray(low, dtype=trsm.dtype)
+    b = numpy.asarray(b, dtype=trsm.dtype)
+    if b.flags.f_contiguous:
+        return trsm(1., low, b, lower=1, overwrite_b=1)
+    else:
+        # b in C order is an F-ordered b.T. Solving x.T * low.T = b.T avoids
+        # copying b to the Fortran order.
+        return trsm(1., low.T, b.T, side=1, lower=0, overwrite_b=1).T
+
 def _round_off_to_odd_mesh(mesh):
     # Round off mesh to the nearest odd numbers.
     # Odd number of grids is preferred because even number of grids may break
@@ -998,5 +1182,5 @@ def _round_off_to_odd_mesh(mesh):
     # between k and -k is used (function conj_j2c) to overcome the error
     # caused by auxiliary basis linear dependency. More detalis of this
     # problem can be found in function _make_j3c.
-    return [(i//2)*2+1 for i in mesh]
+    return (numpy.asarray(mesh, dtype=int) | 1).tolist()
 
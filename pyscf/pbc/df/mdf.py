@@ -87,7 +87,7 @@ def _make_j3c(mydf, cell, auxcell, kptij_lst, cderi_file):
     blksize = max(2048, int(max_memory*.4e6/16/fused_cell.nao_nr()))
     log.debug2('max_memory %s (MB)  blocksize %s', max_memory, blksize)
     for k, kpt in enumerate(uniq_kpts):
-        j2c_k = fuse(fuse(j2c[k]).T).T.copy()
+        j2c_k = fuse(fuse(j2c[k]), axis=1).copy()
         j2c_k = (j2c_k + j2c_k.conj().T) * .5
 
         coulG = mydf.weighted_coulG(kpt, False, mesh)
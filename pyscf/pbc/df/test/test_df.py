@@ -54,9 +54,20 @@ kmdf.kpts = kpts
 # the k-points k and -k
 kmdf.mesh = (6,)*3
 
+# Cartesian cell with general-contracted d shells in the auxiliary basis
+cell_cart = pgto.M(
+    atom='Li 0 0 0; H 2 2 2',
+    a=(numpy.ones([3, 3]) - numpy.eye(3)) * 2,
+    cart=True, basis='sto3g', verbose=0)
+auxbasis_cart = {'H': [[0, [0.5, 1.]],
+                       [2, [1.2, 1., .5], [0.3, .2, 1.]]],
+                 'Li': [[0, [0.8, 1.]],
+                        [1, [0.6, 1.]],
+                        [2, [1.5, 1., .2], [0.4, .3, 1.]]]}
+
 def tearDownModule():
-    global cell, mf0, kmdf
-    del cell, mf0, kmdf
+    global cell, mf0, kmdf, cell_cart
+    del cell, mf0, kmdf, cell_cart
 
 
 class KnownValues(unittest.TestCase):
@@ -168,6 +179,58 @@ Li  P
         eri1 = df.GDF(cell).set(auxbasis=aug_etb(cell)).get_eri()
         self.assertAlmostEqual(abs(eri1-eri0).max(), 0, 2)
 
+    def test_fuse_cart_general_contraction(self):
+        mydf = df.GDF(cell_cart)
+        auxcell = df.make_modrho_basis(cell_cart, auxbasis_cart)
+        fused_cell, fuse = df.fuse_auxcell(mydf, auxcell)
+        aux_loc = auxcell.ao_loc_nr()
+        fused_loc = fused_cell.ao_loc_nr()
+        Lpq = numpy.random.random((fused_loc[-1], 5))
+
+        ref = []
+        for i in range(auxcell.nbas):
+            l = auxcell.bas_angular(i)
+            ia = auxcell.bas_atom(i)
+            nd = (l+1) * (l+2) // 2
+            c2s = gto.cart2sph(l, normalized='sp')
+            # gto.conc_env shifts the atom indices of the compensating shells
+            chg_shl = [j for j in range(auxcell.nbas, fused_cell.nbas)
+                       if (fused_cell.bas_atom(j) - auxcell.natm == ia and
+                           fused_cell.bas_angular(j) == l)]
+            chgLpq = Lpq[fused_loc[chg_shl[0]]:fused_loc[chg_shl[0]+1]]
+            for c in range(auxcell.bas_nctr(i)):
+                p0 = aux_loc[i] + c * nd
+                ref.append(c2s.T.dot(Lpq[p0:p0+nd] - chgLpq))
+        ref = numpy.vstack(ref)
+        self.assertAlmostEqual(abs(fuse(Lpq) - ref).max(), 0, 12)
+
+    def test_fuse_axis1(self):
+        numpy.random.seed(3)
+        for c, auxbasis in ((cell, 'weigend'), (cell_cart, auxbasis_cart)):
+            auxcell = df.make_modrho_basis(c, auxbasis)
+            fused_cell, fuse = df.fuse_auxcell(df.GDF(c), auxcell)
+            nfused = fused_cell.nao_nr()
+            x = numpy.random.random((7,nfused))
+            for v in (x, x + numpy.random.random((7,nfused)) * 1j):
+                ref = fuse(v.T.copy()).T
+                self.assertAlmostEqual(abs(fuse(v.copy(), axis=1) - ref).max(), 0, 14)
+
+    def test_get_2c2e_kpts_threads(self):
+        mydf = df.GDF(cell, kpts[:3])
+        mydf.auxbasis = 'weigend'
+        mydf.mesh = (6,)*3
+        auxcell = df.make_modrho_basis(cell, mydf.auxbasis)
+        fused_cell = df.fuse_auxcell(mydf, auxcell)[0]
+        naux = auxcell.nao_nr()
+        ref = mydf._get_2c2e(fused_cell, naux, kpts[:3],
+                             k_threads_naux_threshold=0)
+        # nworkers > 1 with at least 4 OpenMP threads
+        with lib.with_omp_threads(4):
+            j2c = mydf._get_2c2e(fused_cell, naux, kpts[:3],
+                                 k_threads_naux_threshold=naux+1)
+        for k in range(3):
+            self.assertAlmostEqual(abs(j2c[k] - ref[k]).max(), 0, 12)
+
 
 if __name__ == '__main__':
     print("Full Tests for df")